@@ -2,6 +2,8 @@ import sys
 import os
 import random
 import uuid
+import bisect
+import collections
 from PySide import QtGui, QtCore
 
 import media
@@ -41,7 +43,13 @@ class MainWindow(QtGui.QMainWindow):
 		dock = QtGui.QDockWidget('Color List', self)
 		dock.setAllowedAreas(QtCore.Qt.RightDockWidgetArea)
 		colorTableWidget = ColorTableWidget()
-		dock.setWidget(colorTableWidget)
+		colorTableFilterBar = ColorTableFilterBar(colorTableWidget)
+		colorListLayout = QtGui.QVBoxLayout()
+		colorListLayout.addWidget(colorTableFilterBar)
+		colorListLayout.addWidget(colorTableWidget)
+		colorListWidget = QtGui.QWidget()
+		colorListWidget.setLayout(colorListLayout)
+		dock.setWidget(colorListWidget)
 		self.addDockWidget(QtCore.Qt.RightDockWidgetArea, dock)
 		self.colorTableWidget = colorTableWidget
 
@@ -79,6 +87,13 @@ class MainWindow(QtGui.QMainWindow):
 		viewMenu.addAction(fitInViewAct)
 		viewMenu.addAction(reloadColorListAct)
 
+		sampleColorChartAct = QtGui.QAction('Sample color chart', self)
+		sampleColorChartAct.setStatusTip('Drag a rectangle around a color chart and add every patch')
+		sampleColorChartAct.triggered.connect(self.sampleColorChart)
+
+		toolsMenu = self.menuBar().addMenu('Tools')
+		toolsMenu.addAction(sampleColorChartAct)
+
 	def openImage(self):
 		fileName,_ = QtGui.QFileDialog.getOpenFileName(self, 'Open Image', self.lastOpenDirectoryPath or QtCore.QDir.currentPath(), 'Image Files (*.png *.jpg *.bmp)')
 		if fileName:
@@ -125,6 +140,13 @@ class MainWindow(QtGui.QMainWindow):
 			with open(fileName, 'w') as f:
 				f.write(output)
 
+	def sampleColorChart(self):
+		if not self.image:
+			self.statusBar().showMessage('Open an image first')
+			return
+		self.canvasView.setRegionSelectionEnabled(True)
+		self.statusBar().showMessage('Drag a rectangle around the color chart')
+
 	"""
 	return QColor
 	"""
@@ -168,12 +190,44 @@ class MainWindow(QtGui.QMainWindow):
 		self.colorTableWidget.addNewColorData('', '', color)
 		self.colorTableWidget.selectAndEditLastRowAtColumn(ColorTableWidget.COLUMN_COLOR_NAME)
 
+	def GraphicsCanvasViewDidSelectRegion(self, regionRect):
+		self.canvasView.setRegionSelectionEnabled(False)
+		if not self.image:
+			return
+
+		dialog = ColorChartDialog(regionRect, self)
+		if not dialog.exec_():
+			self.statusBar().showMessage('')
+			return
+
+		corners = dialog.getCorners()
+		if not corners:
+			self.statusBar().showMessage('Corners must be four "x, y" points')
+			return
+
+		try:
+			sampler = ColorChartSampler(corners, dialog.getRows(), dialog.getColumns(), dialog.getInset())
+		except ValueError as e:
+			self.statusBar().showMessage(str(e))
+			return
+		codePrefix = dialog.getCodePrefix()
+		colors = []
+		for row, column, color in sampler.sample(self.image):
+			colorCode = '%s%s%s' % (codePrefix, ColorChartSampler.getRowLabel(row), column + 1)
+			colors.append(('', colorCode, color))
+
+		print 'Add %s colors from chart at %s' % (len(colors), corners)
+		self.colorTableWidget.addNewColorDataList(colors)
+		self.statusBar().showMessage('Added %s colors' % len(colors))
+
 
 class GraphicsCanvasViewDelegate(object):
 	def GraphicsCanvasViewMouseDidMove(self, mousePos):
 		pass
 	def GraphicsCanvasViewMouseDidPress(self, mousePos):
 		pass
+	def GraphicsCanvasViewDidSelectRegion(self, regionRect):
+		pass
 
 
 class GraphicsCanvasView(QtGui.QGraphicsView):
@@ -184,6 +238,16 @@ class GraphicsCanvasView(QtGui.QGraphicsView):
 		self.setDragMode(QtGui.QGraphicsView.ScrollHandDrag)
 		self.onMouseMoveOnImage = None
 		self.delegate = None
+		self._regionSelectionEnabled = False
+		self._regionStartPos = None
+
+	def setRegionSelectionEnabled(self, enabled):
+		self._regionSelectionEnabled = enabled
+		self._regionStartPos = None
+		if enabled:
+			self.setDragMode(QtGui.QGraphicsView.RubberBandDrag)
+		else:
+			self.setDragMode(QtGui.QGraphicsView.ScrollHandDrag)
 
 	def mouseMoveEvent(self, mouseEvent):
 		pos = mouseEvent.pos()
@@ -202,7 +266,22 @@ class GraphicsCanvasView(QtGui.QGraphicsView):
 			if self.delegate:
 				self.delegate.GraphicsCanvasViewMouseDidPress(scenePos)
 		else:
+			if self._regionSelectionEnabled and mouseEvent.button() == QtCore.Qt.LeftButton:
+				self._regionStartPos = scenePos
 			super(GraphicsCanvasView, self).mousePressEvent(mouseEvent)
+
+	def mouseReleaseEvent(self, mouseEvent):
+		super(GraphicsCanvasView, self).mouseReleaseEvent(mouseEvent)
+
+		if self._regionStartPos is None or mouseEvent.button() != QtCore.Qt.LeftButton:
+			return
+		regionRect = QtCore.QRectF(self._regionStartPos, self.mapToScene(mouseEvent.pos())).normalized()
+		self._regionStartPos = None
+		if regionRect.isEmpty():
+			return
+
+		if self.delegate:
+			self.delegate.GraphicsCanvasViewDidSelectRegion(regionRect)
 	
 	def wheelEvent(self, wheelEvent):
 		"""
@@ -230,6 +309,108 @@ class GraphicsCanvasView(QtGui.QGraphicsView):
 		self.translate(delta.x(), delta.y())
 
 
+class ColorChartSampler(object):
+	"""
+	Samples a regular grid of patches, such as a printed color chart. The chart
+	is given by its four corners (top-left, top-right, bottom-right,
+	bottom-left), which may be in perspective. Each patch is averaged over a
+	square around its centre, shrunk by `inset` (0-1) to stay clear of the
+	patch borders.
+	"""
+
+	def __init__(self, corners, rows, columns, inset=0.3):
+		super(ColorChartSampler, self).__init__()
+		self.corners = corners
+		self.rows = rows
+		self.columns = columns
+		self.inset = inset
+		self._transform = ColorChartSampler._getSquareToQuadTransform(corners)
+
+	"""
+	Projective transform from the unit square onto the quad.
+	Credit: Paul Heckbert, Fundamentals of Texture Mapping and Image Warping, 1989
+	"""
+	@staticmethod
+	def _getSquareToQuadTransform(corners):
+		(x0, y0), (x1, y1), (x2, y2), (x3, y3) = [(float(x), float(y)) for x, y in corners]
+		dx3 = x0 - x1 + x2 - x3
+		dy3 = y0 - y1 + y2 - y3
+
+		if dx3 == 0 and dy3 == 0:
+			g = h = 0.0
+		else:
+			dx1, dy1 = x1 - x2, y1 - y2
+			dx2, dy2 = x3 - x2, y3 - y2
+			den = dx1 * dy2 - dx2 * dy1
+			if den == 0:
+				raise ValueError('Corners %s do not form a quadrilateral' % (corners,))
+			g = (dx3 * dy2 - dx2 * dy3) / den
+			h = (dx1 * dy3 - dx3 * dy1) / den
+
+		a, b, c = x1 - x0 + g * x1, x3 - x0 + h * x3, x0
+		d, e, f = y1 - y0 + g * y1, y3 - y0 + h * y3, y0
+		return (a, b, c, d, e, f, g, h)
+
+	def mapFromUnitSquare(self, u, v):
+		a, b, c, d, e, f, g, h = self._transform
+		w = g * u + h * v + 1
+		return ((a * u + b * v + c) / w, (d * u + e * v + f) / w)
+
+	"""
+	return list of (row, column, x, y, halfSize)
+	"""
+	def getPatches(self):
+		patches = []
+		for row in range(self.rows):
+			v0 = row / float(self.rows)
+			v1 = (row + 1) / float(self.rows)
+			vc = (v0 + v1) / 2
+			for column in range(self.columns):
+				u0 = column / float(self.columns)
+				u1 = (column + 1) / float(self.columns)
+				uc = (u0 + u1) / 2
+
+				x, y = self.mapFromUnitSquare(uc, vc)
+				# Distance from the centre to the nearest patch edge
+				edgeDistances = []
+				for u, v in [(u0, vc), (u1, vc), (uc, v0), (uc, v1)]:
+					ex, ey = self.mapFromUnitSquare(u, v)
+					edgeDistances.append(((ex - x) ** 2 + (ey - y) ** 2) ** 0.5)
+				halfSize = min(edgeDistances) * (1 - self.inset)
+				patches.append((row, column, x, y, halfSize))
+		return patches
+
+	"""
+	return list of (row, column, QColor), patches outside of the image are left out
+	"""
+	def sample(self, image):
+		results = []
+		for row, column, x, y, halfSize in self.getPatches():
+			size = max(1, int(round(halfSize * 2)))
+			left = int(round(x - size / 2.0))
+			top = int(round(y - size / 2.0))
+			rect = QtCore.QRect(left, top, size, size).intersected(image.rect())
+			if rect.isEmpty():
+				continue
+
+			# Let Qt average the patch by scaling it down to a single pixel
+			patch = image.copy(rect).scaled(1, 1, QtCore.Qt.IgnoreAspectRatio, QtCore.Qt.SmoothTransformation)
+			results.append((row, column, QtGui.QColor(patch.pixel(0, 0))))
+		return results
+
+	"""
+	0 -> A, 25 -> Z, 26 -> AA
+	"""
+	@staticmethod
+	def getRowLabel(row):
+		label = ''
+		row += 1
+		while row > 0:
+			row, remainder = divmod(row - 1, 26)
+			label = chr(ord('A') + remainder) + label
+		return label
+
+
 class ColorData(object):
 
 	def __init__(self, newUUID):
@@ -265,11 +446,168 @@ class ColorData(object):
 		self.blue = otherColorData.blue
 
 
+class ColorDataIndex(object):
+	"""
+	Search tables over colorName/colorCode and RGB. ColorDataList keeps it up
+	to date on every change, so a search never has to scan all colors.
+	Colors are keyed by uuid.int, which hashes much faster than uuid.UUID.
+	"""
+
+	NGRAM_SIZE = 3
+
+	def __init__(self):
+		super(ColorDataIndex, self).__init__()
+		self.clearAll()
+
+	def clearAll(self):
+		self._textsByUUIDInt = {}
+		self._rgbByUUIDInt = {}
+		# sorted (lowercase text, uuid int), for prefix search. New entries wait
+		# in _unsortedTexts so a bulk load sorts once instead of per insert.
+		self._sortedTexts = []
+		self._unsortedTexts = []
+		# ngram -> set of uuid int, for substring search. Texts shorter
+		# than NGRAM_SIZE are their own ngram.
+		self._uuidIntsByNgram = collections.defaultdict(set)
+		# per channel, value 0-255 -> set of uuid int, for range search
+		self._uuidIntsByChannelValue = tuple([[set() for v in range(256)] for channel in range(3)])
+
+	"""
+	Names loaded from CTM are byte strings, filter text from Qt is unicode.
+	Compare both as unicode, bytes are taken as UTF-8.
+	"""
+	@staticmethod
+	def _toUnicode(text):
+		if isinstance(text, str):
+			return text.decode('utf-8', 'replace')
+		return unicode(text)
+
+	def _getTexts(self, colorData):
+		name = ColorDataIndex._toUnicode(colorData.colorName).lower()
+		code = ColorDataIndex._toUnicode(colorData.colorCode).lower()
+		if name == code:
+			return (name,)
+		return (name, code)
+
+	def _getNgrams(self, texts):
+		n = ColorDataIndex.NGRAM_SIZE
+		return set([t[i:i + n] for t in texts for i in range(max(1, len(t) - n + 1))])
+
+	def add(self, colorData):
+		uuidInt = colorData.getUUID().int
+		texts = self._getTexts(colorData)
+		rgb = (colorData.red, colorData.green, colorData.blue)
+		self._textsByUUIDInt[uuidInt] = texts
+		self._rgbByUUIDInt[uuidInt] = rgb
+
+		self._unsortedTexts.extend([(text, uuidInt) for text in texts])
+		uuidIntsByNgram = self._uuidIntsByNgram
+		for ngram in self._getNgrams(texts):
+			uuidIntsByNgram[ngram].add(uuidInt)
+
+		red, green, blue = self._uuidIntsByChannelValue
+		red[colorData.red].add(uuidInt)
+		green[colorData.green].add(uuidInt)
+		blue[colorData.blue].add(uuidInt)
+
+	def _sortTexts(self):
+		if self._unsortedTexts:
+			self._sortedTexts.extend(self._unsortedTexts)
+			self._sortedTexts.sort()
+			self._unsortedTexts = []
+
+	def remove(self, colorUUID):
+		uuidInt = colorUUID.int
+		texts = self._textsByUUIDInt.pop(uuidInt, None)
+		if texts is None:
+			return
+		rgb = self._rgbByUUIDInt.pop(uuidInt)
+
+		for text in texts:
+			entry = (text, uuidInt)
+			i = bisect.bisect_left(self._sortedTexts, entry)
+			if i < len(self._sortedTexts) and self._sortedTexts[i] == entry:
+				del self._sortedTexts[i]
+			else:
+				self._unsortedTexts.remove(entry)
+		for ngram in self._getNgrams(texts):
+			uuidInts = self._uuidIntsByNgram[ngram]
+			uuidInts.discard(uuidInt)
+			if not uuidInts:
+				del self._uuidIntsByNgram[ngram]
+
+		for channel, value in zip(self._uuidIntsByChannelValue, rgb):
+			channel[value].discard(uuidInt)
+
+	def update(self, colorData):
+		uuidInt = colorData.getUUID().int
+		if self._textsByUUIDInt.get(uuidInt) == self._getTexts(colorData) and \
+			self._rgbByUUIDInt.get(uuidInt) == (colorData.red, colorData.green, colorData.blue):
+			return
+		self.remove(colorData.getUUID())
+		self.add(colorData)
+
+	"""
+	return set of uuid int whose name or code starts with (or contains) text, case insensitive
+	"""
+	def findByText(self, text, prefixOnly=False):
+		text = ColorDataIndex._toUnicode(text).lower()
+		if not text:
+			return set(self._textsByUUIDInt)
+
+		if prefixOnly:
+			self._sortTexts()
+			found = set()
+			i = bisect.bisect_left(self._sortedTexts, (text,))
+			while i < len(self._sortedTexts) and self._sortedTexts[i][0].startswith(text):
+				found.add(self._sortedTexts[i][1])
+				i += 1
+			return found
+
+		# A short query is in a text exactly when it is in one of the text's
+		# ngrams, so scan the distinct ngrams rather than the colors.
+		if len(text) <= ColorDataIndex.NGRAM_SIZE:
+			found = set()
+			for ngram, uuidInts in self._uuidIntsByNgram.iteritems():
+				if text in ngram:
+					found |= uuidInts
+			return found
+
+		candidates = None
+		for uuidInts in sorted([self._uuidIntsByNgram.get(ngram, set()) for ngram in self._getNgrams([text])], key=len):
+			candidates = uuidInts.copy() if candidates is None else candidates & uuidInts
+			if not candidates:
+				return set()
+		return set([u for u in candidates if any(text in t for t in self._textsByUUIDInt[u])])
+
+	"""
+	return set of uuid int whose red, green and blue are all within lower and upper, inclusive
+	"""
+	def findByColorRange(self, lower, upper):
+		# Walk the channel with the fewest candidates and check the other two.
+		buckets = []
+		for channel, low, high in zip(self._uuidIntsByChannelValue, lower, upper):
+			channelBuckets = channel[low:high + 1]
+			buckets.append((sum([len(b) for b in channelBuckets]), channelBuckets))
+		_, channelBuckets = min(buckets, key=lambda b: b[0])
+
+		found = set()
+		for bucket in channelBuckets:
+			for uuidInt in bucket:
+				rgb = self._rgbByUUIDInt[uuidInt]
+				if all(low <= v <= high for v, low, high in zip(rgb, lower, upper)):
+					found.add(uuidInt)
+		return found
+
+
 class ColorDataList(object):
 
 	def __init__(self):
 		super(ColorDataList, self).__init__()
 		self._internalList = []
+		self._colorDataByUUIDInt = {}
+		# Built on the first search, plain loading and exporting never need it
+		self._index = None
 
 	def addNewColorData(self, name, code, red, green, blue, colorDataUUID=None):
 		if not colorDataUUID:
@@ -282,31 +620,61 @@ class ColorDataList(object):
 		newColorData.green = green
 		newColorData.blue = blue
 		self._internalList.append(newColorData)
+		self._colorDataByUUIDInt[colorDataUUID.int] = newColorData
+		if self._index:
+			self._index.add(newColorData)
 		return newColorData.getUUID()
 
 	def getCopyOfColorDataByUUID(self, findUUID):
-		for c in self._internalList:
-			if c.getUUID() == findUUID:
-				return c.clone()
+		c = self._colorDataByUUIDInt.get(findUUID.int)
+		if c:
+			return c.clone()
 		return None
 
 	def removeColorDataByUUID(self, removeUUID):
-		for c in self._internalList:
-			if c.getUUID() == removeUUID:
-				self._internalList.remove(c)
-				return True
-		return False
+		c = self._colorDataByUUIDInt.pop(removeUUID.int, None)
+		if not c:
+			return False
+		self._internalList.remove(c)
+		if self._index:
+			self._index.remove(removeUUID)
+		return True
 
 	def commitChange(self, colorData):
-		for c in self._internalList:
-			if c.getUUID() == colorData.getUUID():
-				c.copyFrom(colorData)
-				return True
-		return False
+		c = self._colorDataByUUIDInt.get(colorData.getUUID().int)
+		if not c:
+			return False
+		c.copyFrom(colorData)
+		if self._index:
+			self._index.update(c)
+		return True
 
 	def clearAll(self):
 		del self._internalList
 		self._internalList = []
+		self._colorDataByUUIDInt = {}
+		self._index = None
+
+	def buildIndex(self):
+		if self._index:
+			return
+		self._index = ColorDataIndex()
+		for c in self._internalList:
+			self._index.add(c)
+
+	"""
+	return set of uuid.int
+	"""
+	def findUUIDIntsByText(self, text, prefixOnly=False):
+		self.buildIndex()
+		return self._index.findByText(text, prefixOnly)
+
+	"""
+	return set of uuid.int
+	"""
+	def findUUIDIntsByColorRange(self, lower, upper):
+		self.buildIndex()
+		return self._index.findByColorRange(lower, upper)
 		
 	def numberOfTotalColors(self):
 		return len(self._internalList)
@@ -379,6 +747,15 @@ class ColorTableWidget(QtGui.QTableWidget):
 		super(ColorTableWidget, self).__init__(0, 6, parent)
 		
 		self._colorDataList = ColorDataList()
+		self._rowByUUIDInt = {}
+		self._hiddenUUIDInts = set()
+		# Rows the user just added stay visible until their next edit
+		self._unfilteredUUIDInts = set()
+		self._filterText = ''
+		self._filterPrefixOnly = False
+		self._filterColorRange = None
+		self._sortColumn = -1
+		self._sortOrder = QtCore.Qt.AscendingOrder
 
 		self.setSelectionBehavior(QtGui.QAbstractItemView.SelectItems)
 		self.setSelectionMode(QtGui.QAbstractItemView.SingleSelection)
@@ -389,12 +766,15 @@ class ColorTableWidget(QtGui.QTableWidget):
 		self.horizontalHeader().resizeSection(ColorTableWidget.COLUMN_COLOR_RED, 40)
 		self.horizontalHeader().resizeSection(ColorTableWidget.COLUMN_COLOR_GREEN, 40)
 		self.horizontalHeader().resizeSection(ColorTableWidget.COLUMN_COLOR_BLUE, 40)
+		self.horizontalHeader().setSortIndicatorShown(True)
+		self.horizontalHeader().setSortIndicator(-1, QtCore.Qt.AscendingOrder)
 		
 		self.verticalHeader().hide()
 		self.setShowGrid(True)
 
 		self.cellActivated.connect(self.onTableCellActivated)
 		self.cellChanged.connect(self.onTableCellChanged)
+		self.horizontalHeader().sortIndicatorChanged.connect(self.onSortIndicatorChanged)
 
 	def onTableCellActivated(self, row, column):
 		item = self.item(row, ColorTableWidget.COLUMN_COLOR_NAME)
@@ -418,12 +798,19 @@ class ColorTableWidget(QtGui.QTableWidget):
 			colorData = self._colorDataList.getCopyOfColorDataByUUID(colorUUID)
 			newValue = item.text()
 			
+			# _setColorDataAt fires this for every row it fills, nothing changes then
 			if column == ColorTableWidget.COLUMN_COLOR_NAME:
+				if colorData.colorName == newValue:
+					return
 				colorData.colorName = newValue
 			elif column == ColorTableWidget.COLUMN_COLOR_CODE:
+				if colorData.colorCode == newValue:
+					return
 				colorData.colorCode = newValue
 
 			self._colorDataList.commitChange(colorData)
+			self._unfilteredUUIDInts.discard(colorUUID.int)
+			self._applyFilter()
 
 	def _addNewBlankRow(self):
 		colorThumbnail = ColorThumbnail(QtGui.QColor(QtCore.Qt.white), parent=self)
@@ -464,34 +851,55 @@ class ColorTableWidget(QtGui.QTableWidget):
 		colorThumbnail = self.cellWidget(row, ColorTableWidget.COLUMN_COLOR_THUMBNAIL)
 		colorThumbnail.color = QtGui.QColor(red, green, blue)
 
+		# Set the uuid first, setText() fires cellChanged which commits by uuid
 		colorNameItem = self.item(row, ColorTableWidget.COLUMN_COLOR_NAME)
-		colorNameItem.setText(colorName)
 		colorNameItem.colorDataUUID = colorDataUUID
+		colorNameItem.setText(colorName)
 		
 		colorCodeItem = self.item(row, ColorTableWidget.COLUMN_COLOR_CODE)
-		colorCodeItem.setText(colorCode)
 		colorCodeItem.colorDataUUID = colorDataUUID
+		colorCodeItem.setText(colorCode)
 
+		# Numbers rather than text, so the columns sort numerically
 		colorRedItem = self.item(row, ColorTableWidget.COLUMN_COLOR_RED)
-		colorRedItem.setText(str(red))
+		colorRedItem.setData(QtCore.Qt.DisplayRole, red)
 
 		colorGreenItem = self.item(row, ColorTableWidget.COLUMN_COLOR_GREEN)
-		colorGreenItem.setText(str(green))
+		colorGreenItem.setData(QtCore.Qt.DisplayRole, green)
 
 		colorBlueItem = self.item(row, ColorTableWidget.COLUMN_COLOR_BLUE)
-		colorBlueItem.setText(str(blue))
+		colorBlueItem.setData(QtCore.Qt.DisplayRole, blue)
+
+		self._rowByUUIDInt[colorDataUUID.int] = row
 
 	def addNewColorData(self, colorName, colorCode, colorAsQColor):
-		r = colorAsQColor.red()
-		g = colorAsQColor.green()
-		b = colorAsQColor.blue()
-		colorDataUUID = self._colorDataList.addNewColorData(colorName, colorCode, r, g, b)
-		colorData = self._colorDataList.getCopyOfColorDataByUUID(colorDataUUID)
+		self.addNewColorDataList([(colorName, colorCode, colorAsQColor)])
 
-		self._addNewBlankRow()
-		row = self.rowCount()
-		row -= 1
-		self._setColorDataAt(row, colorData)
+	"""
+	colors: list of (colorName, colorCode, QColor)
+	The table is repainted once, after every row is added.
+	"""
+	def addNewColorDataList(self, colors):
+		self.setUpdatesEnabled(False)
+		self.blockSignals(True)
+		try:
+			for colorName, colorCode, colorAsQColor in colors:
+				r = colorAsQColor.red()
+				g = colorAsQColor.green()
+				b = colorAsQColor.blue()
+				colorDataUUID = self._colorDataList.addNewColorData(colorName, colorCode, r, g, b)
+				colorData = self._colorDataList.getCopyOfColorDataByUUID(colorDataUUID)
+				self._unfilteredUUIDInts.add(colorDataUUID.int)
+
+				self._addNewBlankRow()
+				row = self.rowCount()
+				row -= 1
+				self._setColorDataAt(row, colorData)
+
+			self._applyFilter()
+		finally:
+			self.blockSignals(False)
+			self.setUpdatesEnabled(True)
 
 	def selectAndEditLastRowAtColumn(self, column):
 		row = self.rowCount() - 1
@@ -500,6 +908,10 @@ class ColorTableWidget(QtGui.QTableWidget):
 		self.editItem(item)
 
 	def reload(self):
+		self._showAllRows()
+		self._rowByUUIDInt = {}
+		self._unfilteredUUIDInts = set()
+		self._setSortIndicator(-1, QtCore.Qt.AscendingOrder)
 		numberOfTotalColors = self._colorDataList.numberOfTotalColors()
 
 		while self.rowCount() > numberOfTotalColors:
@@ -514,6 +926,76 @@ class ColorTableWidget(QtGui.QTableWidget):
 			self._setColorDataAt(row, colorData)
 			row += 1
 
+		self._applyFilter()
+
+	def onSortIndicatorChanged(self, column, order):
+		# The header has already flipped the indicator on click
+		if column == ColorTableWidget.COLUMN_COLOR_THUMBNAIL:
+			self._setSortIndicator(self._sortColumn, self._sortOrder)
+			return
+		if column < 0:
+			return
+		self.sortRows(column, order)
+
+	def _setSortIndicator(self, column, order):
+		self._sortColumn = column
+		self._sortOrder = order
+		header = self.horizontalHeader()
+		header.blockSignals(True)
+		header.setSortIndicator(column, order)
+		header.blockSignals(False)
+
+	def sortRows(self, column, order=QtCore.Qt.AscendingOrder):
+		self._setSortIndicator(column, order)
+
+		# Items and thumbnails move with the sort, hidden rows don't
+		self._showAllRows()
+		self.sortItems(column, order)
+
+		self._rowByUUIDInt = {}
+		for row in range(self.rowCount()):
+			item = self.item(row, ColorTableWidget.COLUMN_COLOR_NAME)
+			if hasattr(item, 'colorDataUUID'):
+				self._rowByUUIDInt[item.colorDataUUID.int] = row
+		self._applyFilter()
+
+	def setFilter(self, text='', prefixOnly=False, colorRange=None):
+		"""
+		Hide every row whose name and code don't match text, or whose color is
+		outside colorRange, a ((r, g, b), (r, g, b)) pair of inclusive bounds.
+		"""
+		self._filterText = text
+		self._filterPrefixOnly = prefixOnly
+		self._filterColorRange = colorRange
+		self._applyFilter()
+
+	def _showAllRows(self):
+		for uuidInt in self._hiddenUUIDInts:
+			row = self._rowByUUIDInt.get(uuidInt)
+			if row is not None:
+				self.setRowHidden(row, False)
+		self._hiddenUUIDInts = set()
+
+	def _applyFilter(self):
+		matches = None
+		if self._filterText:
+			matches = self._colorDataList.findUUIDIntsByText(self._filterText, self._filterPrefixOnly)
+		if self._filterColorRange:
+			lower, upper = self._filterColorRange
+			rangeMatches = self._colorDataList.findUUIDIntsByColorRange(lower, upper)
+			matches = rangeMatches if matches is None else matches & rangeMatches
+
+		hiddenUUIDInts = set()
+		if matches is not None:
+			hiddenUUIDInts = set(self._rowByUUIDInt) - matches - self._unfilteredUUIDInts
+
+		# Only touch the rows whose visibility changed
+		for uuidInt in hiddenUUIDInts - self._hiddenUUIDInts:
+			self.setRowHidden(self._rowByUUIDInt[uuidInt], True)
+		for uuidInt in self._hiddenUUIDInts - hiddenUUIDInts:
+			self.setRowHidden(self._rowByUUIDInt[uuidInt], False)
+		self._hiddenUUIDInts = hiddenUUIDInts
+
 	def loadFromCTM(self, fileName):
 		content = None
 		with open(fileName) as f:
@@ -522,6 +1004,8 @@ class ColorTableWidget(QtGui.QTableWidget):
 			return
 
 		self._colorDataList.loadFromCTMContent(content)
+		# Index now rather than on the first keystroke in the filter bar
+		self._colorDataList.buildIndex()
 		self.reload()
 
 	def exportAsCTM(self):
@@ -531,6 +1015,158 @@ class ColorTableWidget(QtGui.QTableWidget):
 		return self._colorDataList.exportAsCSV(delimeter)
 
 
+class ColorTableFilterBar(QtGui.QWidget):
+
+	def __init__(self, colorTableWidget, parent=None):
+		super(ColorTableFilterBar, self).__init__(parent)
+
+		self.colorTableWidget = colorTableWidget
+
+		self.textEdit = QtGui.QLineEdit()
+		self.textEdit.setPlaceholderText('Search name or code')
+		self.textEdit.textChanged.connect(self.onFilterChanged)
+
+		self.matchModeComboBox = QtGui.QComboBox()
+		self.matchModeComboBox.addItems(['Contains', 'Starts with'])
+		self.matchModeComboBox.currentIndexChanged.connect(self.onFilterChanged)
+
+		self.colorRangeEdit = QtGui.QLineEdit()
+		self.colorRangeEdit.setPlaceholderText('#000000-#ffffff')
+		self.colorRangeEdit.setToolTip('Color or color range, as #rrggbb or "r g b", e.g. #800000-#ff4040')
+		self.colorRangeEdit.textChanged.connect(self.onFilterChanged)
+
+		layout = QtGui.QGridLayout()
+		layout.setContentsMargins(0, 0, 0, 0)
+		layout.addWidget(self.textEdit, 0, 0)
+		layout.addWidget(self.matchModeComboBox, 0, 1)
+		layout.addWidget(self.colorRangeEdit, 1, 0, 1, 2)
+		self.setLayout(layout)
+
+	def onFilterChanged(self, *args):
+		text = self.textEdit.text()
+		prefixOnly = self.matchModeComboBox.currentIndex() == 1
+		colorRange = ColorTableFilterBar.parseColorRange(self.colorRangeEdit.text())
+		self.colorTableWidget.setFilter(text, prefixOnly, colorRange)
+
+	"""
+	return (r, g, b) or None
+	"""
+	@staticmethod
+	def parseColor(text):
+		text = text.strip()
+		try:
+			if text.startswith('#'):
+				if len(text) != 7:
+					return None
+				value = int(text[1:], 16)
+				return ((value >> 16) & 0xff, (value >> 8) & 0xff, value & 0xff)
+
+			rgb = tuple([int(v) for v in text.replace(',', ' ').split()])
+		except ValueError:
+			return None
+		if len(rgb) != 3 or not all(0 <= v <= 255 for v in rgb):
+			return None
+		return rgb
+
+	"""
+	"lower-upper" or a single color for an exact match
+	return ((r, g, b), (r, g, b)) or None
+	"""
+	@staticmethod
+	def parseColorRange(text):
+		bounds = [ColorTableFilterBar.parseColor(t) for t in text.split('-')]
+		if len(bounds) == 1:
+			bounds = bounds * 2
+		if len(bounds) != 2 or None in bounds:
+			return None
+		lower, upper = bounds
+		return (tuple(map(min, lower, upper)), tuple(map(max, lower, upper)))
+
+
+class ColorChartDialog(QtGui.QDialog):
+
+	def __init__(self, regionRect, parent=None):
+		super(ColorChartDialog, self).__init__(parent)
+		self.setWindowTitle('Sample color chart')
+
+		self.rowsSpinBox = QtGui.QSpinBox()
+		self.rowsSpinBox.setRange(1, 100)
+		self.rowsSpinBox.setValue(4)
+
+		self.columnsSpinBox = QtGui.QSpinBox()
+		self.columnsSpinBox.setRange(1, 100)
+		self.columnsSpinBox.setValue(6)
+
+		self.insetSpinBox = QtGui.QSpinBox()
+		self.insetSpinBox.setRange(0, 95)
+		self.insetSpinBox.setSuffix('%')
+		self.insetSpinBox.setValue(30)
+		self.insetSpinBox.setToolTip('How much of each patch to leave out around its border')
+
+		self.codePrefixEdit = QtGui.QLineEdit()
+		self.codePrefixEdit.setToolTip('Codes are prefix + row letter + column number, e.g. A1')
+
+		# Corners default to the dragged rectangle, edit them for a chart in perspective
+		self.cornerEdits = []
+		cornerPoints = [regionRect.topLeft(), regionRect.topRight(), regionRect.bottomRight(), regionRect.bottomLeft()]
+		cornerNames = ['Top left', 'Top right', 'Bottom right', 'Bottom left']
+		cornersLayout = QtGui.QFormLayout()
+		for name, point in zip(cornerNames, cornerPoints):
+			cornerEdit = QtGui.QLineEdit('%d, %d' % (point.x(), point.y()))
+			cornersLayout.addRow(name, cornerEdit)
+			self.cornerEdits.append(cornerEdit)
+
+		self.cornersGroupBox = QtGui.QGroupBox('Perspective corners')
+		self.cornersGroupBox.setCheckable(True)
+		self.cornersGroupBox.setChecked(False)
+		self.cornersGroupBox.setLayout(cornersLayout)
+		self._regionCorners = [(point.x(), point.y()) for point in cornerPoints]
+
+		buttonBox = QtGui.QDialogButtonBox(QtGui.QDialogButtonBox.Ok | QtGui.QDialogButtonBox.Cancel)
+		buttonBox.accepted.connect(self.accept)
+		buttonBox.rejected.connect(self.reject)
+
+		formLayout = QtGui.QFormLayout()
+		formLayout.addRow('Rows', self.rowsSpinBox)
+		formLayout.addRow('Columns', self.columnsSpinBox)
+		formLayout.addRow('Inset', self.insetSpinBox)
+		formLayout.addRow('Code prefix', self.codePrefixEdit)
+
+		mainLayout = QtGui.QVBoxLayout()
+		mainLayout.addLayout(formLayout)
+		mainLayout.addWidget(self.cornersGroupBox)
+		mainLayout.addWidget(buttonBox)
+		self.setLayout(mainLayout)
+
+	def getRows(self):
+		return self.rowsSpinBox.value()
+
+	def getColumns(self):
+		return self.columnsSpinBox.value()
+
+	def getInset(self):
+		return self.insetSpinBox.value() / 100.0
+
+	def getCodePrefix(self):
+		return self.codePrefixEdit.text()
+
+	"""
+	return list of four (x, y), or None if a corner can't be read
+	"""
+	def getCorners(self):
+		if not self.cornersGroupBox.isChecked():
+			return self._regionCorners
+
+		corners = []
+		for cornerEdit in self.cornerEdits:
+			try:
+				x, y = [float(v) for v in cornerEdit.text().replace(',', ' ').split()]
+			except ValueError:
+				return None
+			corners.append((x, y))
+		return corners
+
+
 def main():
 	app = QtGui.QApplication(sys.argv)
 	QtGui.QApplication.addLibraryPath('./')
@@ -0,0 +1,262 @@
+import sys
+import os
+import uuid
+import heapq
+import itertools
+import tempfile
+import argparse
+
+
+MERGE_POLICY_FIRST = 'first'
+MERGE_POLICY_LAST = 'last'
+MERGE_POLICY_FAIL = 'fail'
+MERGE_POLICIES = (MERGE_POLICY_FIRST, MERGE_POLICY_LAST, MERGE_POLICY_FAIL)
+
+DIFF_ADDED = '+'
+DIFF_REMOVED = '-'
+DIFF_CHANGED = '~'
+
+DEFAULT_SORT_CHUNK_SIZE = 100000
+# Most sorted runs merged at once, which bounds the number of open files
+MAX_MERGE_FAN_IN = 64
+
+
+"""
+Same rules as ColorDataList.loadFromCTMContent, one line at a time.
+return (uuid string, name, code, red, green, blue) or None
+"""
+def _parseCTMLine(line):
+	delimeter=','
+	c = line.rstrip('\r\n').split(delimeter)
+	if len(c) != 6:
+		return None
+	colorUUID = uuid.UUID(c[0])
+	return (str(colorUUID), c[1], c[2], int(c[3]), int(c[4]), int(c[5]))
+
+
+def _formatCTMLine(record):
+	delimeter=','
+	return delimeter.join([str(v) for v in record]) + '\n'
+
+
+def _readCTMRecords(fileName):
+	with open(fileName) as f:
+		for line in f:
+			record = _parseCTMLine(line)
+			if record:
+				yield record
+
+
+def isSortedByUUID(fileName):
+	lastUUID = None
+	for record in _readCTMRecords(fileName):
+		if lastUUID is not None and record[0] < lastUUID:
+			return False
+		lastUUID = record[0]
+	return True
+
+
+def _readNumberedCTMRecords(fileName):
+	for lineNumber, record in enumerate(_readCTMRecords(fileName)):
+		yield (record[0], lineNumber, record)
+
+
+def _readRunRecords(runFileName):
+	delimeter=','
+	with open(runFileName) as f:
+		for line in f:
+			lineNumber, ctmLine = line.split(delimeter, 1)
+			record = _parseCTMLine(ctmLine)
+			yield (record[0], int(lineNumber), record)
+
+
+class SortedCTMReader(object):
+	"""
+	Iterates (uuid string, line number, record) of a CTM file in UUID order,
+	records with the same UUID stay in file order. Files that are already
+	sorted are streamed as they are; otherwise they are split into sorted runs
+	of at most `chunkSize` records in temporary files, which are merged back
+	at most `maxFanIn` runs at a time.
+	"""
+
+	def __init__(self, fileName, chunkSize=DEFAULT_SORT_CHUNK_SIZE, maxFanIn=MAX_MERGE_FAN_IN):
+		super(SortedCTMReader, self).__init__()
+		if chunkSize < 1:
+			raise ValueError('Chunk size must be at least 1, got %s' % chunkSize)
+		if maxFanIn < 2:
+			raise ValueError('Merge fan-in must be at least 2, got %s' % maxFanIn)
+		self.fileName = fileName
+		self.chunkSize = chunkSize
+		self.maxFanIn = maxFanIn
+		self._runFileNames = []
+
+	def __iter__(self):
+		if isSortedByUUID(self.fileName):
+			return _readNumberedCTMRecords(self.fileName)
+
+		self._writeSortedRuns()
+		self._mergeRunsDownToFanIn()
+		return heapq.merge(*[_readRunRecords(runFileName) for runFileName in self._runFileNames])
+
+	def _writeRun(self, numberedRecords):
+		delimeter=','
+		fd, runFileName = tempfile.mkstemp(suffix='.ctm')
+		self._runFileNames.append(runFileName)
+		with os.fdopen(fd, 'w') as f:
+			for _, lineNumber, record in numberedRecords:
+				f.write(str(lineNumber) + delimeter + _formatCTMLine(record))
+
+	def _writeSortedRuns(self):
+		records = _readNumberedCTMRecords(self.fileName)
+		while True:
+			chunk = list(itertools.islice(records, self.chunkSize))
+			if not chunk:
+				break
+			# (uuid, line number) is unique, records themselves are never compared
+			chunk.sort()
+			self._writeRun(chunk)
+			del chunk
+
+	def _mergeRunsDownToFanIn(self):
+		while len(self._runFileNames) > self.maxFanIn:
+			runFileNames = self._runFileNames
+			self._runFileNames = []
+			for i in range(0, len(runFileNames), self.maxFanIn):
+				group = runFileNames[i:i + self.maxFanIn]
+				self._writeRun(heapq.merge(*[_readRunRecords(runFileName) for runFileName in group]))
+				for runFileName in group:
+					os.remove(runFileName)
+
+	def close(self):
+		for runFileName in self._runFileNames:
+			os.remove(runFileName)
+		self._runFileNames = []
+
+
+def _iterateGroupedByUUID(fileNames, chunkSize):
+	"""
+	yield (uuid string, [(file index, record), ...]) in UUID order,
+	records of the same UUID are ordered by file index, then by line.
+	"""
+	readers = [SortedCTMReader(fileName, chunkSize) for fileName in fileNames]
+	try:
+		def tagged(reader, fileIndex):
+			for colorUUID, lineNumber, record in reader:
+				yield (colorUUID, fileIndex, lineNumber, record)
+
+		streams = [tagged(reader, i) for i, reader in enumerate(readers)]
+		for colorUUID, group in itertools.groupby(heapq.merge(*streams), key=lambda t: t[0]):
+			yield colorUUID, [(fileIndex, record) for _, fileIndex, _, record in group]
+	finally:
+		for reader in readers:
+			reader.close()
+
+
+def mergeCTMFiles(fileNames, output, policy=MERGE_POLICY_LAST, chunkSize=DEFAULT_SORT_CHUNK_SIZE):
+	"""
+	Write the union of all records to `output` in UUID order. When a UUID has
+	different records in several files, `policy` picks the one from the first
+	or the last file, or raises ValueError.
+	return number of records written
+	"""
+	if policy not in MERGE_POLICIES:
+		raise ValueError('Unknown merge policy: %s' % policy)
+
+	count = 0
+	for colorUUID, entries in _iterateGroupedByUUID(fileNames, chunkSize):
+		records = [record for _, record in entries]
+		if policy == MERGE_POLICY_FIRST:
+			record = records[0]
+		else:
+			record = records[-1]
+
+		if policy == MERGE_POLICY_FAIL and any(r != record for r in records):
+			raise ValueError('Conflicting records for %s in %s' % (colorUUID, ', '.join(fileNames[i] for i, _ in entries)))
+
+		output.write(_formatCTMLine(record))
+		count += 1
+	return count
+
+
+def diffCTMFiles(oldFileName, newFileName, output, chunkSize=DEFAULT_SORT_CHUNK_SIZE):
+	"""
+	Write the records that differ between two CTM files to `output` in UUID
+	order, each prefixed by DIFF_ADDED, DIFF_REMOVED or DIFF_CHANGED. Changed
+	records are written with their new values.
+	return number of differences
+	"""
+	delimeter=','
+	count = 0
+	for colorUUID, entries in _iterateGroupedByUUID([oldFileName, newFileName], chunkSize):
+		oldRecords = [record for fileIndex, record in entries if fileIndex == 0]
+		newRecords = [record for fileIndex, record in entries if fileIndex == 1]
+
+		if not oldRecords:
+			change, record = DIFF_ADDED, newRecords[-1]
+		elif not newRecords:
+			change, record = DIFF_REMOVED, oldRecords[-1]
+		elif oldRecords[-1] != newRecords[-1]:
+			change, record = DIFF_CHANGED, newRecords[-1]
+		else:
+			continue
+
+		output.write(change + delimeter + _formatCTMLine(record))
+		count += 1
+	return count
+
+
+def _positiveInt(text):
+	value = int(text)
+	if value < 1:
+		raise argparse.ArgumentTypeError('must be at least 1: %s' % text)
+	return value
+
+
+def main():
+	commonParser = argparse.ArgumentParser(add_help=False)
+	commonParser.add_argument('-o', '--output', help='output file, default is stdout')
+	commonParser.add_argument('--chunk-size', type=_positiveInt, default=DEFAULT_SORT_CHUNK_SIZE, help='records per sorted run when a file has to be sorted')
+
+	parser = argparse.ArgumentParser(description='Merge or diff CTM catalogs by UUID.')
+	subparsers = parser.add_subparsers(dest='command')
+
+	mergeParser = subparsers.add_parser('merge', parents=[commonParser], help='merge two or more CTM files')
+	mergeParser.add_argument('files', nargs='+')
+	mergeParser.add_argument('--policy', choices=MERGE_POLICIES, default=MERGE_POLICY_LAST, help='which record wins when a UUID differs between files')
+
+	diffParser = subparsers.add_parser('diff', parents=[commonParser], help='list records added, removed or changed between two CTM files')
+	diffParser.add_argument('old')
+	diffParser.add_argument('new')
+
+	args = parser.parse_args()
+	if args.command == 'merge' and len(args.files) < 2:
+		parser.error('merge needs at least two files')
+
+	# Only replace the output file once everything was written.
+	output = sys.stdout
+	temporaryPath = None
+	try:
+		if args.output:
+			temporaryPath = args.output + '.tmp'
+			output = open(temporaryPath, 'w')
+
+		if args.command == 'merge':
+			mergeCTMFiles(args.files, output, policy=args.policy, chunkSize=args.chunk_size)
+		else:
+			diffCTMFiles(args.old, args.new, output, chunkSize=args.chunk_size)
+
+		if temporaryPath:
+			output.close()
+			os.rename(temporaryPath, args.output)
+			temporaryPath = None
+	except (IOError, OSError, ValueError) as e:
+		sys.exit(str(e))
+	finally:
+		if output is not sys.stdout:
+			output.close()
+		if temporaryPath and os.path.exists(temporaryPath):
+			os.remove(temporaryPath)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,296 @@
+import sys
+import os
+import time
+import fnmatch
+import argparse
+import multiprocessing
+from PySide import QtGui
+
+from catalogmaker import ColorDataList
+
+
+IMAGE_FILE_EXTENSIONS = ('.png', '.jpg', '.bmp')
+
+
+class CoordinateTemplate(object):
+	"""
+	Sampling points for every image whose file name matches `pattern`.
+	Template file format is one point per line: name,code,x,y
+	"""
+
+	def __init__(self, pattern, points):
+		super(CoordinateTemplate, self).__init__()
+		self.pattern = pattern
+		self.points = points
+
+	def matches(self, fileName):
+		return fnmatch.fnmatch(os.path.basename(fileName), self.pattern)
+
+	@staticmethod
+	def loadFromFile(pattern, fileName):
+		delimeter=','
+		points = []
+		with open(fileName) as f:
+			for line in f.read().split('\n'):
+				c = line.split(delimeter)
+				if len(c) != 4:
+					continue
+				points.append((c[0], c[1], int(c[2]), int(c[3])))
+		return CoordinateTemplate(pattern, points)
+
+
+"""
+Run inside a worker process, so it only takes and returns plain values.
+return list of (name, code, red, green, blue)
+"""
+def _sampleImageAtPoints(imagePath, points):
+	image = QtGui.QImage(imagePath)
+	if image.isNull():
+		raise IOError('Could not decode image %s' % imagePath)
+
+	results = []
+	for name, code, x, y in points:
+		if (x < 0 or y < 0) or (x >= image.width() or y >= image.height()):
+			raise ValueError('Point <%s %s> is outside of %s' % (x, y, imagePath))
+		color = QtGui.QColor(image.pixel(x, y))
+		results.append((name, code, color.red(), color.green(), color.blue()))
+	return results
+
+
+def _replaceFile(sourcePath, destinationPath):
+	# os.rename does not overwrite on Windows
+	if os.name == 'nt' and os.path.exists(destinationPath):
+		os.remove(destinationPath)
+	os.rename(sourcePath, destinationPath)
+
+
+class WatchFolderService(object):
+	"""
+	Polls a directory for new images, samples them in a bounded process pool
+	and writes a CTM (and optionally CSV) file next to each image. Results can
+	also be appended to a master catalog.
+
+	An image is only submitted once its size stays the same between two polls,
+	so files that are still being copied in are left alone. At most
+	`maxPendingJobs` images are in flight; the rest wait in the directory until
+	a slot frees up. Failed images are retried on later polls up to
+	`maxRetries` times, so each image gets at most `maxRetries` + 1 attempts.
+
+	A job that is not done `jobTimeout` seconds after it was submitted counts
+	as failed. A worker that crashes never finishes its job, so the pool is
+	then recreated.
+	"""
+
+	def __init__(self, watchDirectoryPath, templates, masterCatalogPath=None, exportCSV=False, numberOfWorkers=2, maxPendingJobs=8, maxRetries=3, pollInterval=1.0, jobTimeout=60.0):
+		super(WatchFolderService, self).__init__()
+
+		self.watchDirectoryPath = watchDirectoryPath
+		self.templates = templates
+		self.masterCatalogPath = masterCatalogPath
+		self.exportCSV = exportCSV
+		self.numberOfWorkers = numberOfWorkers
+		self.maxPendingJobs = maxPendingJobs
+		self.maxRetries = maxRetries
+		self.pollInterval = pollInterval
+		self.jobTimeout = jobTimeout
+
+		self._pool = None
+		self._pendingJobs = {}
+		self._lastSeenSizes = {}
+		# image path -> (mtime, number of failures of that version)
+		self._failureCounts = {}
+		self._finishedImages = {}
+
+	def findTemplateForImage(self, imagePath):
+		for template in self.templates:
+			if template.matches(imagePath):
+				return template
+		return None
+
+	def _getOutputPath(self, imagePath, format):
+		return os.path.splitext(imagePath)[0] + '.' + format
+
+	def _getFailureCount(self, imagePath, mtime):
+		failedMTime, failureCount = self._failureCounts.get(imagePath, (None, 0))
+		if failedMTime != mtime:
+			return 0
+		return failureCount
+
+	def _recordFailure(self, imagePath, mtime, action, error):
+		failureCount = self._getFailureCount(imagePath, mtime) + 1
+		self._failureCounts[imagePath] = (mtime, failureCount)
+		print '%s %s failed (attempt %s of %s): %s' % (action, imagePath, failureCount, self.maxRetries + 1, error)
+
+	def _isAlreadyProcessed(self, imagePath, mtime):
+		if self._finishedImages.get(imagePath) == mtime:
+			return True
+		if self._getFailureCount(imagePath, mtime) > self.maxRetries:
+			return True
+
+		# Survive restarts: an output newer than its image means it is done.
+		outputPath = self._getOutputPath(imagePath, 'ctm')
+		if os.path.exists(outputPath) and os.path.getmtime(outputPath) >= mtime:
+			self._finishedImages[imagePath] = mtime
+			return True
+		return False
+
+	def _findReadyImages(self):
+		readyImages = []
+		seenSizes = {}
+		for fileName in sorted(os.listdir(self.watchDirectoryPath)):
+			if os.path.splitext(fileName)[1].lower() not in IMAGE_FILE_EXTENSIONS:
+				continue
+
+			imagePath = os.path.join(self.watchDirectoryPath, fileName)
+			if imagePath in self._pendingJobs:
+				continue
+			try:
+				stat = os.stat(imagePath)
+			except OSError:
+				continue
+			if self._isAlreadyProcessed(imagePath, stat.st_mtime):
+				continue
+
+			seenSizes[imagePath] = stat.st_size
+			if self._lastSeenSizes.get(imagePath) == stat.st_size:
+				readyImages.append((imagePath, stat.st_mtime))
+
+		self._lastSeenSizes = seenSizes
+		return readyImages
+
+	def _submitReadyImages(self):
+		for imagePath, mtime in self._findReadyImages():
+			if len(self._pendingJobs) >= self.maxPendingJobs:
+				break
+
+			template = self.findTemplateForImage(imagePath)
+			if not template:
+				print 'No template matches %s, skipped' % imagePath
+				self._finishedImages[imagePath] = mtime
+				continue
+
+			asyncResult = self._pool.apply_async(_sampleImageAtPoints, (imagePath, template.points))
+			self._pendingJobs[imagePath] = (asyncResult, mtime, time.time())
+
+	def _createPool(self):
+		self._pool = multiprocessing.Pool(self.numberOfWorkers)
+
+	def _terminatePool(self):
+		self._pool.terminate()
+		self._pool.join()
+		self._pool = None
+
+	def _collectFinishedJobs(self):
+		hasTimedOutJobs = False
+		for imagePath, (asyncResult, mtime, submitTime) in self._pendingJobs.items():
+			if not asyncResult.ready():
+				if time.time() - submitTime > self.jobTimeout:
+					del self._pendingJobs[imagePath]
+					self._recordFailure(imagePath, mtime, 'Sampling', 'timed out after %s seconds' % self.jobTimeout)
+					hasTimedOutJobs = True
+				continue
+			del self._pendingJobs[imagePath]
+
+			try:
+				samples = asyncResult.get()
+			except Exception as e:
+				self._recordFailure(imagePath, mtime, 'Sampling', e)
+				continue
+
+			try:
+				self._writeOutputs(imagePath, samples)
+			except (IOError, OSError) as e:
+				self._recordFailure(imagePath, mtime, 'Writing results of', e)
+				continue
+
+			self._failureCounts.pop(imagePath, None)
+			self._finishedImages[imagePath] = mtime
+			print 'Sampled %s colors from %s' % (len(samples), imagePath)
+
+		if hasTimedOutJobs:
+			# The stuck worker may hold a slot forever. Jobs still queued on the
+			# old pool are dropped without a failure and submitted again later.
+			print 'Restarting worker pool'
+			self._pendingJobs = {}
+			self._terminatePool()
+			self._createPool()
+
+	def _writeOutputs(self, imagePath, samples):
+		colorDataList = ColorDataList()
+		for name, code, red, green, blue in samples:
+			colorDataList.addNewColorData(name, code, red, green, blue)
+
+		outputs = [('ctm', colorDataList.exportAsCTM())]
+		if self.exportCSV:
+			outputs.append(('csv', colorDataList.exportAsCSV()))
+
+		temporaryPaths = []
+		try:
+			for format, output in outputs:
+				temporaryPath = self._getOutputPath(imagePath, format) + '.tmp'
+				temporaryPaths.append(temporaryPath)
+				with open(temporaryPath, 'w') as f:
+					f.write(output)
+
+			if self.masterCatalogPath:
+				with open(self.masterCatalogPath, 'a') as f:
+					f.write(colorDataList.exportAsCTM())
+
+			# CTM goes last, its presence marks the image as done.
+			for (format, _), temporaryPath in reversed(zip(outputs, temporaryPaths)):
+				_replaceFile(temporaryPath, self._getOutputPath(imagePath, format))
+		finally:
+			for temporaryPath in temporaryPaths:
+				if os.path.isfile(temporaryPath):
+					os.remove(temporaryPath)
+
+	def pollOnce(self):
+		self._collectFinishedJobs()
+		self._submitReadyImages()
+
+	def run(self):
+		self._createPool()
+		print 'Watching %s' % self.watchDirectoryPath
+		try:
+			while True:
+				self.pollOnce()
+				time.sleep(self.pollInterval)
+		except KeyboardInterrupt:
+			pass
+		finally:
+			self._terminatePool()
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Watch a directory and sample colors from new images.')
+	parser.add_argument('directory', help='directory to watch')
+	parser.add_argument('-t', '--template', action='append', default=[], metavar='PATTERN=FILE', help='coordinate template for images whose name matches PATTERN, may be repeated')
+	parser.add_argument('-c', '--catalog', help='master CTM catalog to append every result to')
+	parser.add_argument('--csv', action='store_true', help='also write a CSV next to each image')
+	parser.add_argument('-j', '--workers', type=int, default=2)
+	parser.add_argument('--max-pending', type=int, default=8)
+	parser.add_argument('--retries', type=int, default=3, help='times a failed image is retried after its first attempt')
+	parser.add_argument('--interval', type=float, default=1.0)
+	parser.add_argument('--timeout', type=float, default=60.0, help='seconds before a sampling job counts as failed')
+	args = parser.parse_args()
+
+	templates = []
+	for t in args.template:
+		pattern, sep, fileName = t.partition('=')
+		if not sep:
+			parser.error('template must be given as PATTERN=FILE: %s' % t)
+		templates.append(CoordinateTemplate.loadFromFile(pattern, fileName))
+
+	service = WatchFolderService(args.directory, templates,
+		masterCatalogPath=args.catalog,
+		exportCSV=args.csv,
+		numberOfWorkers=args.workers,
+		maxPendingJobs=args.max_pending,
+		maxRetries=args.retries,
+		pollInterval=args.interval,
+		jobTimeout=args.timeout)
+	service.run()
+
+
+if __name__ == '__main__':
+	main()